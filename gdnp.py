@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*
 #
 # Copyright (c) 2018 Université Clermont Auvergne, CNRS/IN2P3, LPC
@@ -26,139 +26,227 @@ import os
 import re
 import sys
 import textwrap
-import xml.etree.ElementTree as ET
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
+# Pattern of the pointer suffix appended by Geant4 to GDML names
+_HEX_SUFFIX = re.compile("0x[0-9a-fA-F]{7}")
 
-def load_gdml(path):
-    """Load the content of a GDML file and sort the data by ownership"""
+# Conversion factors from GDML units to the MCNP system
+_GDML_UNITS = {"m": 1E+02, "cm": 1., "mm": 1E-01, "g/cm3": 1.}
 
-    # Parse the GDML file
-    tree = ET.parse(path)
-    gdml = tree.getroot()
 
-    # Map solids
-    solids = {}
-    for solid in gdml.find("solids"):
-        solids[solid.attrib["name"]] = solid
-
-    # Map materials
-    materials = {}
-    for material in gdml.find("materials"):
-        materials[material.attrib["name"]] = material
-
-    # Map the cells
-    cells = {}
-    for structure in gdml.find("structure"):
-        # Get the geometry
-        solid_ref = structure.find("solidref").attrib["ref"]
-        solid = solids[solid_ref]
-        if solid.tag in ("intersection", "subtraction", "union"):
-            # This is a logical volume
-            first = solids[solid.find("first").attrib["ref"]]
-            second = solids[solid.find("second").attrib["ref"]]
-            solid = (solid.tag, (first.tag, first.attrib),
-                     (second.tag, second.attrib), solid.find("position").attrib)
-        else:
-            # This is a base volume
-            solid = (solid.tag, solid.attrib)
+def _release_element(element):
+    """Free the memory used by an already processed XML element"""
+    element.clear()
+    try:
+        # With lxml, the processed siblings must also be unlinked
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    except AttributeError:
+        pass
 
-        # Get the material
-        material_ref = structure.find("materialref").attrib["ref"]
-        material = materials[material_ref]
 
-        # Get any children
-        children = structure.findall("physvol")
+def load_gdml(path):
+    """Load the content of a GDML file and sort the data by ownership"""
 
-        # Add this cell
-        ref = structure.attrib["name"]
-        name = re.sub("0x.......", "", ref)
-        cells[ref] = {"name": name, "volume": solid, "position": None,
-                      "material": material, "children": children}
+    # Parse the GDML file incrementally. Note that GDML items must be defined
+    # before being referenced. Thus, solids and materials are already mapped
+    # when a structure is parsed
+    solids, materials, cells = {}, {}, {}
+    world_ref = None
+    section, depth = None, 0
+    with open(path, "rb") as f:
+        for event, element in ET.iterparse(f, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 2:
+                    section = element.tag
+                continue
+
+            depth -= 1
+            if depth == 1:
+                # This is the end of a section
+                _release_element(element)
+                continue
+            elif depth != 2:
+                # Sub-elements are processed together with their parent
+                continue
+
+            tag = element.tag
+            if section == "materials":
+                if tag == "material":
+                    # Map materials, as (name, density) tuples. Names are
+                    # interned since they key the MCNP materials as well
+                    name = sys.intern(element.attrib["name"])
+                    density = None
+                    for item in element:
+                        if item.tag == "D":
+                            density = dict(item.attrib)
+                            break
+                    materials[name] = (name, density)
+            elif section == "solids":
+                # Map solids, as lightweight tuples
+                name = element.attrib["name"]
+                if tag in ("intersection", "subtraction", "union"):
+                    first = second = position = None
+                    for item in element:
+                        t = item.tag
+                        if t == "first":
+                            first = item.attrib["ref"]
+                        elif t == "second":
+                            second = item.attrib["ref"]
+                        elif t == "position":
+                            position = dict(item.attrib)
+                    solids[name] = (tag, first, second, position)
+                else:
+                    solids[name] = (tag, dict(element.attrib))
+            elif section == "structure":
+                if tag == "volume":
+                    # Get the geometry, the material and any children, as
+                    # (reference, position) tuples, in a single pass
+                    solid_ref = material_ref = None
+                    children = []
+                    for item in element:
+                        t = item.tag
+                        if t == "solidref":
+                            solid_ref = item.attrib["ref"]
+                        elif t == "materialref":
+                            material_ref = item.attrib["ref"]
+                        elif t == "physvol":
+                            child_ref = position = None
+                            for sub_item in item:
+                                t = sub_item.tag
+                                if t == "volumeref":
+                                    child_ref = sub_item.attrib["ref"]
+                                elif t == "position":
+                                    position = dict(sub_item.attrib)
+                            children.append((child_ref, position))
+
+                    solid = solids[solid_ref]
+                    if solid[0] in ("intersection", "subtraction", "union"):
+                        # This is a logical volume
+                        solid = (solid[0], solids[solid[1]], solids[solid[2]],
+                                 solid[3])
+                    material = materials[material_ref]
+
+                    # Add this cell
+                    ref = element.attrib["name"]
+                    name = _HEX_SUFFIX.sub("", ref)
+                    cells[ref] = {"name": name, "volume": solid,
+                                  "position": None, "material": material,
+                                  "children": children}
+            elif section == "setup":
+                if (tag == "world") and (world_ref is None):
+                    world_ref = element.attrib["ref"]
+
+            _release_element(element)
 
     # Set the children positions, w.r.t. their parent
-    for name, cell in cells.iteritems():
+    get_cell = cells.__getitem__
+    for cell in cells.values():
         if not cell["children"]:
             continue
         c = []
-        for child in children:
-            child_ref = child.find("volumeref").attrib["ref"]
-            sub_cell = cells[child_ref]
-            position = child.find("position")
+        for child_ref, position in cell["children"]:
+            sub_cell = get_cell(child_ref)
             if position is not None:
-                sub_cell["position"] = position.attrib
+                sub_cell["position"] = position
             c.append(sub_cell)
         cell["children"] = c
 
     # Get the world cell
-    world_ref = gdml.find("setup").find("world").attrib["ref"]
     world = cells[world_ref]
 
     return world
 
 
+class MCNPCell:
+    """An MCNP cell card"""
+
+    __slots__ = ("name", "index", "material", "density", "surfaces")
+
+    # Global list of all cells
+    cells = []
+
+    # Register a new cell
+    def __init__(self, name, surfaces, material, density):
+        self.name = name
+        self.index = len(self.cells) + 1
+        self.material = material
+        self.density = density
+        self.surfaces = surfaces
+        self.cells.append(self)
+
+
+class MCNPMaterial:
+    """An MCNP material, indexed by its GDML name"""
+
+    __slots__ = ("index", "density", "name")
+
+    # Global dictionary of all materials
+    materials = {}
+
+    # Fetch or register the material
+    def __init__(self, gdml):
+        name, d = gdml
+        try:
+            m = self.materials[name]
+        except KeyError:
+            self.materials[name] = self
+            self.index = len(self.materials)
+            self.density = float(d["value"]) * _GDML_UNITS[d["unit"]]
+            self.name = _HEX_SUFFIX.sub("", name)
+        else:
+            self.index = m.index
+            self.density = m.density
+            self.name = m.name
+
+
 def dump_mcnp(gdml, world, path=None):
     """Dump sorted GDML data in MCNP format"""
 
-    class MCNPSurface:
-        # Global dictionary of all unique surfaces
-        surfaces = {}
-
-        # Fetch or register the surface
-        def __init__(self, args):
-            args = tuple(map(str, args))
-            try:
-                s = self.surfaces[args]
-            except KeyError:
-                self.surfaces[args] = self
-                self.index = len(self.surfaces)
-                self.args = args
-            else:
-                self.index = s.index
-                self.args = s.args
-
-    class MCNPCell:
-        # Global list of all cells
-        cells = []
-
-        # Register a new cell
-        def __init__(self, name, surfaces, material, density):
-            self.name = name
-            self.index = len(self.cells) + 1
-            self.material = str(material)
-            self.density = str(density)
-            self.surfaces = " ".join(map(str, surfaces))
-            self.cells.append(self)
-
-    class MCNPMaterial:
-        # Global dictionary of all materials
-        materials = {}
+    # Reset the cells and materials of any previous dump
+    MCNPCell.cells = []
+    MCNPMaterial.materials = {}
 
-        # Fetch or register the material
-        def __init__(self, gdml):
-            name = gdml.attrib["name"]
-            try:
-                m = self.materials[name]
-            except KeyError:
-                self.materials[name] = self
-                self.index = len(self.materials)
-                d = gdml.find("D").attrib
-                self.density = float(d["value"]) * convert_gdml_unit(d["unit"])
-                self.name = re.sub("0x.......", "", name)
-            else:
-                self.index = m.index
-                self.density = m.density
-                self.name = m.name
-
-    # Convert GDML structures to MCNP cells, recursively
-    def process_cell(cell):
-        # Loop over child cells and get their reverted outer surface indices
-        inner_surfaces = []
-        for sub_cell in cell["children"]:
-            inner_surfaces.append(process_cell(sub_cell))
+    # Global dictionary of all unique surfaces, mapping their arguments to
+    # their index
+    surface_indices = {}
+
+    # Format a card value. Floats are rounded to 12 significant digits, as str
+    # did with Python 2, such that round-off errors do not duplicate surfaces
+    def format_value(value):
+        if isinstance(value, float):
+            return str(float("{:.12g}".format(value)))
+        else:
+            return str(value)
+
+    # Fetch or register a surface and return its index. The formatted
+    # arguments are interned since many surfaces share the same values
+    def register_surface(args):
+        args = tuple(sys.intern(format_value(arg)) for arg in args)
+        return surface_indices.setdefault(args, len(surface_indices) + 1)
+
+    # Convert GDML structures to MCNP cells. The tree of cells is walked
+    # depth first using an explicit stack, such that children are processed
+    # before their parent
+    stack = [(world, iter(world["children"]), [])]
+    while stack:
+        cell, children, inner_surfaces = stack[-1]
+        try:
+            sub_cell = next(children)
+        except StopIteration:
+            stack.pop()
+        else:
+            stack.append((sub_cell, iter(sub_cell["children"]), []))
+            continue
 
         # Build the volume and register the cell outer surfaces
         surfaces = convert_gdml_volume(cell["volume"], cell["position"])
-        outer_surfaces = [s[0] * MCNPSurface(s[1:]).index for s in surfaces]
+        outer_surfaces = [s[0] * register_surface(s[1:]) for s in surfaces]
 
         # Fetch or register the material
         material = MCNPMaterial(cell["material"])
@@ -167,23 +255,20 @@ def dump_mcnp(gdml, world, path=None):
         surfaces = outer_surfaces + inner_surfaces
         MCNPCell(cell["name"], surfaces, material.index, material.density)
 
-        return "".join(("(", ":".join([str(-i) for i in outer_surfaces]), ")"))
-
-    process_cell(world)
-
-    # Instanciate the writer
-    if path is not None:
-        outfile = open(path, "w+")
+        # Provide the reverted outer surfaces to the parent cell
+        if stack:
+            stack[-1][2].append("({})".format(
+                ":".join([str(-i) for i in outer_surfaces])))
 
+    # Instanciate the writer. Lines are buffered and flushed at once
+    lines = []
     wrapper = textwrap.TextWrapper(width=79, subsequent_indent=6 * " ")
 
     def write(*args):
-        text = wrapper.fill(" ".join(args))
-        if path is None:
-            print text
-        else:
-            outfile.write(text)
-            outfile.write("\n")
+        text = " ".join(args)
+        if len(text) > wrapper.width:
+            text = wrapper.fill(text)
+        lines.append(text + "\n")
 
     def format_index(index):
         return "{:5d}".format(index)
@@ -199,17 +284,19 @@ def dump_mcnp(gdml, world, path=None):
     write("C", 77 * "-")
     for cell in MCNPCell.cells:
         write("C ---", cell.name)
-        write(format_index(cell.index), cell.material, cell.density,
-              cell.surfaces)
+        write(format_index(cell.index), str(cell.material),
+              format_value(cell.density), " ".join(map(str, cell.surfaces)))
     write("")
 
     # Dump the surface cards
     write("C", 77 * "-")
     write("C --- SURFACE CARDS")
     write("C", 77 * "-")
-    surfaces = [(s.index, s.args) for s in MCNPSurface.surfaces.values()]
-    for surface in sorted(surfaces):
-        write(format_index(surface[0]), " ".join(surface[1]))
+    surfaces = len(surface_indices) * [None]
+    for args, index in surface_indices.items():
+        surfaces[index - 1] = args
+    for index, args in enumerate(surfaces, 1):
+        write(format_index(index), " ".join(args))
     write("")
 
     # Dump the material headers
@@ -221,23 +308,26 @@ def dump_mcnp(gdml, world, path=None):
         write("C --- MATERIAL :", material[1])
         write("M{:<4d}".format(material[0]), "$ TODO: fill me")
 
-    if path is not None:
-        outfile.close()
+    if path is None:
+        sys.stdout.write("".join(lines))
+    else:
+        with open(path, "w+") as outfile:
+            outfile.writelines(lines)
 
 
 def convert_gdml_unit(unit):
     """Convert a GDML unit to MCNP system"""
-    units = {"m": 1E+02, "cm": 1., "mm": 1E-01, "g/cm3": 1.}
-    return units[unit]
+    return _GDML_UNITS[unit]
 
 
 def convert_gdml_position(position):
     """Convert a GDML position to a 3-tuple"""
-    unit = convert_gdml_unit(position["unit"])
-    return map(lambda a: float(position[a]) * unit, ("x", "y", "z"))
+    unit = _GDML_UNITS[position["unit"]]
+    return (float(position["x"]) * unit, float(position["y"]) * unit,
+            float(position["z"]) * unit)
 
 
-class NotImplemented(Exception):
+class GeometryNotImplemented(NotImplementedError):
     pass
 
 
@@ -252,10 +342,9 @@ def convert_gdml_volume(volume, position):
     # Check for a binary volume
     tag = volume[0]
     if tag == "intersection":
-        transform = convert_gdml_position(volume[3])
-        t = {"x": str(placement[0] + transform[0]),
-             "y": str(placement[1] + transform[1]),
-             "z": str(placement[2] + transform[2]),
+        x, y, z = placement
+        dx, dy, dz = convert_gdml_position(volume[3])
+        t = {"x": str(x + dx), "y": str(y + dy), "z": str(z + dz),
              "unit": "cm"}
         sections = convert_gdml_volume(volume[1], position)
         sections += convert_gdml_volume(volume[2], t)
@@ -263,9 +352,9 @@ def convert_gdml_volume(volume, position):
 
     # Fetch the converter and call it
     try:
-        convert = globals()["convert_gdml_" + tag]
+        convert = _CONVERTERS[tag]
     except KeyError:
-        raise NotImplemented(tag)
+        raise GeometryNotImplemented(tag)
     else:
         return convert(volume[1], placement)
 
@@ -274,35 +363,50 @@ def convert_gdml_tube(volume, placement):
     """Convert a GDML tube to MCNP surfaces
     """
     if (float(volume["startphi"]) != 0) or (float(volume["deltaphi"]) < 360):
-        raise NotImplemented("extruded tube")
-    if (placement[0] != 0) or (placement[1] != 0):
-        raise NotImplemented("offset tube")
-
-    unit = convert_gdml_unit(volume["lunit"])
-    r, dz = map(lambda a: float(volume[a]) * unit, ("rmax", "z"))
+        raise GeometryNotImplemented("extruded tube")
+    x, y, z = placement
+    if (x != 0) or (y != 0):
+        raise GeometryNotImplemented("offset tube")
+
+    unit = _GDML_UNITS[volume["lunit"]]
+    r = float(volume["rmax"]) * unit
+    dz = float(volume["z"]) * unit
     return [
         (-1, "CZ", r),
-        (+1, "PZ", -0.5 * dz + placement[2]),
-        (-1, "PZ", +0.5 * dz + placement[2])
+        (+1, "PZ", -0.5 * dz + z),
+        (-1, "PZ", +0.5 * dz + z)
     ]
 
 
 def convert_gdml_ellipsoid(volume, placement):
     """Convert a GDML ellipsoid to MCNP surfaces
     """
-    ax, by, cz, z0, z1 = map(lambda s: float(volume[s]),
-                             ("ax", "by", "cz", "zcut1", "zcut2"))
-    sections = [(-1, "SQ", 1 / ax**2, 1 / by**2, 1 / cz**2, 0, 0, 0, 1,
-                 placement[0], placement[1], placement[2])]
+    ax = float(volume["ax"])
+    by = float(volume["by"])
+    cz = float(volume["cz"])
+    z0 = float(volume["zcut1"])
+    z1 = float(volume["zcut2"])
+    x, y, z = placement
+    sections = [(-1, "SQ", 1 / (ax * ax), 1 / (by * by), 1 / (cz * cz),
+                 0, 0, 0, 1, x, y, z)]
 
     if z0 > -cz:
-        sections.append((+1, "PZ", z0 + placement[2]))
+        sections.append((+1, "PZ", z0 + z))
     if z1 < cz:
-        sections.append((-1, "PZ", z1 + placement[2]))
+        sections.append((-1, "PZ", z1 + z))
 
     return sections
 
 
+# Table of GDML volume converters, indexed by volume tag
+_CONVERTERS = {
+    name[len("convert_gdml_"):]: function
+    for name, function in list(globals().items())
+    if name.startswith("convert_gdml_") and name not in (
+        "convert_gdml_unit", "convert_gdml_position", "convert_gdml_volume")
+}
+
+
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         helper = ("Usage: gdnp.py [FILE.GDML] ([MCNP.CARD])",